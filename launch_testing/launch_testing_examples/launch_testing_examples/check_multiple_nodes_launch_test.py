@@ -13,9 +13,10 @@
 # limitations under the License.
 
 
-import string
+import os
 import time
 import unittest
+import uuid
 
 import launch
 import launch.actions
@@ -25,57 +26,83 @@ import launch_testing.markers
 import pytest
 import rclpy
 from rclpy.node import Node
-import secrets
+
+# Number of demo nodes to launch, can be raised for stress testing
+NUM_NODES = int(os.environ.get('NUM_NODES', '3'))
 
 
 @pytest.mark.launch_test
 @launch_testing.markers.keep_alive
 def generate_test_description():
-    launch_actions = []
-    node_names = []
-
-    for i in range(3):
-        launch_actions.append(
-            launch_ros.actions.Node(
-                executable='talker',
-                package='demo_nodes_cpp',
-                name='demo_node_' + str(i)
-            )
-        )
-        node_names.append('demo_node_' + str(i))
-
+    node_names = [f'demo_node_{i}' for i in range(NUM_NODES)]
+    node_kwargs = {'executable': 'talker', 'package': 'demo_nodes_cpp'}
+    launch_node = launch_ros.actions.Node
+    launch_actions = [launch_node(name=name, **node_kwargs) for name in node_names]
     launch_actions.append(launch_testing.actions.ReadyToTest())
     return launch.LaunchDescription(launch_actions), {'node_list': node_names}
 
 
 class CheckMultipleNodesLaunched(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # Share a single context and observer node across all the checks
+        cls.context = rclpy.Context()
+        rclpy.init(context=cls.context)
+        try:
+            cls.node = Node('_check_multiple_nodes_observer', context=cls.context)
+        except Exception:
+            # tearDownClass is not called when setUpClass raises
+            rclpy.shutdown(context=cls.context)
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.node.destroy_node()
+        rclpy.shutdown(context=cls.context)
+
     def test_nodes_successful(self, node_list):
         """Check if all the nodes were launched correctly."""
+        wait_for_nodes = WaitForNodes(
+            node_list, timeout=10.0, context=self.context, node=self.node)
+
         # Method 1
-        wait_for_nodes_1 = WaitForNodes(node_list, timeout=10.0)
-        assert wait_for_nodes_1.wait()
-        assert wait_for_nodes_1.get_nodes_not_found() == set()
-        wait_for_nodes_1.shutdown()
+        assert wait_for_nodes.wait()
+        assert wait_for_nodes.get_nodes_not_found() == set()
 
-        # Method 2
-        with WaitForNodes(node_list, timeout=10.0) as wait_for_nodes_2:
+        # Method 2, the same instance can be reused with the 'with' keyword
+        with wait_for_nodes:
             print('All nodes were found !')
-            assert wait_for_nodes_2.get_nodes_not_found() == set()
+            assert wait_for_nodes.get_nodes_not_found() == set()
+            assert wait_for_nodes.snapshot().issuperset(node_list)
+
+        # Several groups of nodes can be checked against the same graph snapshots
+        assert WaitForNodes.wait_many(
+            [node_list[:1], node_list[1:]], timeout=10.0,
+            context=self.context, node=self.node) == [True, True]
 
     def test_node_does_not_exist(self, node_list):
         """Insert a invalid node name that should not exist."""
-        invalid_node_list = node_list + ['invalid_node']
+        invalid_node_list = (*node_list, 'invalid_node')
+
+        # Make sure the launched nodes have been discovered first, so that settle_time
+        # only cuts short the wait for the node that really does not exist
+        assert WaitForNodes(
+            node_list, timeout=10.0, context=self.context, node=self.node).wait()
 
         # Method 1
-        wait_for_nodes_1 = WaitForNodes(invalid_node_list, timeout=10.0)
+        wait_for_nodes_1 = WaitForNodes(
+            invalid_node_list, timeout=10.0, context=self.context, node=self.node,
+            settle_time=0.5)
         assert not wait_for_nodes_1.wait()
         assert wait_for_nodes_1.get_nodes_not_found() == {'invalid_node'}
         wait_for_nodes_1.shutdown()
 
         # Method 2
         with pytest.raises(RuntimeError):
-            with WaitForNodes(invalid_node_list, timeout=10.0):
+            with WaitForNodes(
+                    invalid_node_list, timeout=10.0, context=self.context, node=self.node,
+                    settle_time=0.5):
                 pass
 
 
@@ -101,52 +128,135 @@ class WaitForNodes:
         with WaitForNodes(['foo', 'bar'], timeout=5.0) as wait_for_nodes:
             assert wait_for_nodes.get_nodes_not_found() == set()
             print('Nodes found!')
+
+    An existing context and observer node can be passed in to avoid creating a new
+    participant for every check; they are left untouched by shutdown().
+    snapshot() returns the nodes currently in the graph, without waiting.
+    If settle_time is given, wait() gives up early once some of the nodes were found and
+    the graph has not changed for that many seconds while others are still missing.
+    wait_many() waits for several groups of nodes at once, sharing a single observer node.
     """
 
-    def __init__(self, node_names, timeout=5.0):
-        self.node_names = node_names
+    def __init__(self, node_names, timeout=5.0, context=None, node=None, settle_time=None):
+        self.node_names = tuple(node_names)
         self.timeout = timeout
-        self.__ros_context = rclpy.Context()
-        rclpy.init(context=self.__ros_context)
-        self._prepare_node()
+        self.settle_time = settle_time
+        if node is not None:
+            context = node.context
+        self.__owns_context = context is None
+        if self.__owns_context:
+            context = rclpy.Context()
+            rclpy.init(context=context)
+        self.__ros_context = context
+        self.__owns_node = node is None
+        self.__shutdown_done = False
+        self._prepare_node(node)
 
-        self.__expected_nodes_set = set(node_names)
+        self.__expected_nodes_set = frozenset(self.node_names)
         self.__nodes_found = None
+        self.__nodes_not_found = None
 
-    def _prepare_node(self):
-        self.__node_name = '_test_node_' +\
-            ''.join(secrets.SystemRandom().choices(string.ascii_uppercase + string.digits, k=10))
+    def _prepare_node(self, node=None):
+        if node is not None:
+            self.__node_name = node.get_name()
+            self.__exclude = frozenset((self.__node_name,))
+            self.__ros_node = node
+            return
+        self.__node_name = '_test_node_' + uuid.uuid4().hex[:10].upper()
+        self.__exclude = frozenset((self.__node_name,))
         self.__ros_node = Node(node_name=self.__node_name, context=self.__ros_context)
 
+    def _set_nodes_found(self, nodes_found):
+        self.__nodes_found = nodes_found
+        self.__nodes_not_found = None
+
     def wait(self):
-        start = time.time()
-        flag = False
+        if not rclpy.ok(context=self.__ros_context):
+            raise RuntimeError('Context has been shut down, cannot wait for nodes !')
+        deadline = time.monotonic() + self.timeout
         print('Waiting for nodes')
-        while time.time() - start < self.timeout and not flag:
-            flag = all(name in self.__ros_node.get_node_names() for name in self.node_names)
-            time.sleep(0.3)
+        # Poll, backing off from a short initial delay so that fast discovery
+        # is noticed quickly without spinning on the graph for slow discovery.
+        delay = 0.01
+        previous = None
+        stable_since = None
+        while True:
+            current = self.snapshot()
+            if self.__expected_nodes_set.issubset(current):
+                self._set_nodes_found(current)
+                return True
+            now = time.monotonic()
+            if current != previous:
+                previous = current
+                stable_since = now
+            # Only give up early once discovery has started to report expected nodes,
+            # an empty graph or one without any of them may just not be up yet
+            settling = (
+                self.settle_time is not None and
+                not current.isdisjoint(self.__expected_nodes_set))
+            if settling and now - stable_since >= self.settle_time:
+                # The graph has settled without the missing nodes appearing
+                break
+            remaining = deadline - now
+            if settling:
+                remaining = min(remaining, stable_since + self.settle_time - now)
+            if remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 1.7, 0.3)
+
+        self._set_nodes_found(current)
+        return False
+
+    @classmethod
+    def wait_many(cls, groups, timeout=5.0, context=None, node=None, settle_time=None):
+        groups = [frozenset(group) for group in groups]
+        wait_for_nodes = cls(
+            frozenset().union(*groups), timeout=timeout, context=context, node=node,
+            settle_time=settle_time)
+        try:
+            wait_for_nodes.wait()
+            nodes_found = wait_for_nodes.get_nodes_found()
+        finally:
+            wait_for_nodes.shutdown()
+        return [group.issubset(nodes_found) for group in groups]
 
-        self.__nodes_found = set(self.__ros_node.get_node_names())
-        self.__nodes_found.remove(self.__node_name)
-        return flag
+    def snapshot(self):
+        return frozenset(self.__ros_node.get_node_names()) - self.__exclude
 
     def shutdown(self):
-        self.__ros_node.destroy_node()
-        rclpy.shutdown(context=self.__ros_context)
+        if self.__shutdown_done:
+            return
+        self.__shutdown_done = True
+        try:
+            if self.__owns_node:
+                self.__ros_node.destroy_node()
+        finally:
+            # Make sure the context is released even if destroying the node failed
+            if self.__owns_context:
+                rclpy.shutdown(context=self.__ros_context)
 
     def __enter__(self):
         if not self.wait():
+            # __exit__ is not called when __enter__ raises
+            self.shutdown()
             raise RuntimeError('Did not find all nodes !')
 
         return self
 
     def __exit__(self, exep_type, exep_value, trace):
-        if exep_type is not None:
-            raise Exception('Exception occured, value: ', exep_value)
-        self.shutdown()
+        try:
+            self.shutdown()
+        except Exception:
+            # Do not mask the exception raised inside the 'with' block
+            if exep_type is None:
+                raise
+        return False
 
     def get_nodes_found(self):
         return self.__nodes_found
 
     def get_nodes_not_found(self):
-        return self.__expected_nodes_set - self.__nodes_found
+        if self.__nodes_not_found is None:
+            self.__nodes_not_found = self.__expected_nodes_set - self.__nodes_found
+        return self.__nodes_not_found